@@ -0,0 +1,54 @@
+"""Times the batched Entities update and render culling paths
+Run directly, e.g. python benchmark.py
+"""
+
+# Import core modules
+import time
+import random
+
+# Import pygame and numpy
+import pygame
+import numpy
+
+# Import game
+import runner
+
+def main(entityCount: int = 5000, solidCount: int = 50000, ticks: int = 60):
+    """Prints the average time per tick for entities in a world that keeps growing"""
+    random.seed(0)
+    tile = pygame.Surface((32, 32))
+    image = pygame.Surface((20, 20))
+    game = runner.Game({"block": tile, "space": tile, "coin": tile}, None, 32)
+    for _ in range(solidCount):
+        game.add_solid((random.randint(-400, 400), random.randint(-400, 400)), tile)
+
+    physics = runner.Player.physicsDictionary(
+        jump=19, gravity=1, maxFall=32,
+        maxSpeed=7, speed=2, jumps=1,
+    )
+    entities = runner.Entities()
+    for _ in range(entityCount):
+        entities.spawn(image, pygame.Rect(
+            random.randint(-12800, 12800), random.randint(-12800, 12800), 20, 20
+        ), physics)
+    direction = numpy.random.default_rng(0).integers(-1, 2, entities.alive.size)
+
+    # Warm up, merging the initial solids
+    entities.update(game.solidMap, direction)
+
+    start = time.perf_counter()
+    for tick in range(ticks):
+        # Generation adds solids and spaces every tick
+        game.add_solid((1000 + tick, 0), tile)
+        game.add_space((1000 + tick, 1), tile)
+        entities.update(game.solidMap, direction)
+        entities.sprites(pygame.Rect(0, 0, 512, 512))
+    perTick = (time.perf_counter() - start) / ticks
+
+    print(
+        f"{entityCount} entities, {solidCount} solids: {perTick*1000:.2f} ms per tick "
+        f"({perTick*runner.config['tps']:.0%} of a {runner.config['tps']} tps frame)"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,22 @@ from __future__ import annotations
 
 # Import core modules
 import os
+import json
+import math
 import typing
+import logging
 import random
+import asyncio
+import functools
 import itertools
+import concurrent.futures
 
 # Import pygame
 import pygame
 
+# Import numpy, used for batched entity physics
+import numpy
+
 # Define config
 config = {
     "windowWidth": 512,
@@ -26,8 +35,17 @@ config = {
     "coinDensity": 0.005,
     "blockClumpRadius": 1,
     "blockClumpDensity": 0.8,
+    "frameReserve": 0.002,
+    "generationBudget": 0.002,
+    "generationMargin": 4,
+    "autosaveBudget": 0.001,
+    "autosaveInterval": 30,
+    "savePath": "save.json",
 }
 
+# Logger for problems that should not stop the game
+logger = logging.getLogger(__name__)
+
 # Define path function that turns a relative path into an absolute path based on file location
 def path(local: str) -> str:
     """Returns the absolute path of local path, based on this file location"""
@@ -217,10 +235,14 @@ class Grid:
 
     def viewbox_tiles(self, viewbox: Viewbox):
         """Returns a set of tile coordinates viewable by the given viewbox"""
+        return self.rect_tiles(viewbox.rect)
+
+    def rect_tiles(self, rect: pygame.Rect):
+        """Returns a set of tile coordinates touched by the given rect"""
 
         # Find top-left and bottom-right bounds
-        topLeft = self.index(viewbox.rect.topleft)
-        bottomRight = self.index(viewbox.rect.bottomright)
+        topLeft = self.index(rect.topleft)
+        bottomRight = self.index(rect.bottomright)
 
         # Return generated set
         return {
@@ -242,6 +264,94 @@ class Grid:
         The image should probably be a multiple of .scale"""
         return Block(self.rect(index).topleft, image)
 
+class SolidMap:
+    """Tracks which grid tiles are solid, for batched collision lookups
+    Tile coordinates are packed into single int64 keys,
+    stored sorted so that many tiles can be checked at once with a binary search
+    """
+
+    def __init__(self, scale: int):
+
+        # Reference scale
+        self.scale = scale
+
+        # Set of solid tile coordinates
+        self.tiles = set()
+
+        # Sorted key array, with changes since it was last merged
+        # Changes are merged in one batch when keys are next needed
+        self._keys = numpy.empty(0, dtype=numpy.int64)
+        self._added = set()
+        self._removed = set()
+
+    def __contains__(self, key: typing.Tuple[int, int]) -> bool:
+        """Checks if the given tile is solid"""
+        return key in self.tiles
+
+    def __len__(self) -> int:
+        """Returns the number of solid tiles"""
+        return len(self.tiles)
+
+    def add(self, index: typing.Tuple[int, int]) -> None:
+        """Marks the given tile as solid"""
+        if index in self.tiles:
+            return
+        self.tiles.add(index)
+        # A pending removal means the key is still in the array
+        if index in self._removed:
+            self._removed.discard(index)
+        else:
+            self._added.add(index)
+
+    def discard(self, index: typing.Tuple[int, int]) -> None:
+        """Marks the given tile as not solid, if it was"""
+        if index not in self.tiles:
+            return
+        self.tiles.discard(index)
+        # A pending addition means the key never reached the array
+        if index in self._added:
+            self._added.discard(index)
+        else:
+            self._removed.add(index)
+
+    @staticmethod
+    def pack(columns: numpy.ndarray, rows: numpy.ndarray) -> numpy.ndarray:
+        """Packs arrays of tile columns and rows into int64 keys
+        Rows are offset so that negative coordinates stay unique
+        """
+        return columns.astype(numpy.int64) * (1 << 32) + (rows.astype(numpy.int64) + (1 << 31))
+
+    @classmethod
+    def pack_tiles(cls, tiles: typing.Collection[typing.Tuple[int, int]]) -> numpy.ndarray:
+        """Packs a collection of tile coordinates into a sorted array of keys"""
+        tiles = numpy.array(list(tiles), dtype=numpy.int64).reshape(-1, 2)
+        return numpy.sort(cls.pack(tiles[:, 0], tiles[:, 1]))
+
+    def keys(self) -> numpy.ndarray:
+        """Returns the sorted array of solid tile keys, merging pending changes if needed
+        Only the changed keys are sorted, so the cost does not grow with every solid ever made
+        """
+        if self._removed:
+            removed = self.pack_tiles(self._removed)
+            self._keys = numpy.delete(self._keys, numpy.searchsorted(self._keys, removed))
+            self._removed.clear()
+        if self._added:
+            added = self.pack_tiles(self._added)
+            self._keys = numpy.insert(self._keys, numpy.searchsorted(self._keys, added), added)
+            self._added.clear()
+        return self._keys
+
+    def solid(self, columns: numpy.ndarray, rows: numpy.ndarray) -> numpy.ndarray:
+        """Returns a boolean array of whether each (column, row) tile is solid"""
+        keys = self.keys()
+        query = self.pack(columns, rows)
+        # Nothing can be solid in an empty map
+        if not keys.size:
+            return numpy.zeros(query.shape, dtype=bool)
+        # Binary search for each query, clipping misses past the end
+        found = numpy.minimum(numpy.searchsorted(keys, query), keys.size - 1)
+        return keys[found] == query
+
 class Keyset:
     """Gives symbolic names to pygame keys
     Allows linking multiple keys to a single name,
@@ -386,15 +496,17 @@ class Player(Solid):
             # Stop movement
             self.speed.y = 0
 
-    def collect(self, collectables: typing.Iterable[Item]):
-        """Collects and kills any colliding Items"""
+    def collect(self, collectables: typing.Iterable[Item]) -> typing.List[Item]:
+        """Collects and kills any colliding Items, returning them"""
         # Iterates through what will probably be a list/sprite group
         # Only iterates through the ones in collision
-        for item in self.collisions(collectables):
+        items = self.collisions(collectables)
+        for item in items:
             # Collect the inventory of the item
             self.inventory.collect(item.inventory)
             # Remove the collectable
             item.kill()
+        return items
 
     def accelerate_x(self, change: int):
         """Updates the horizontal speed, respecting config maxSpeed"""
@@ -467,8 +579,10 @@ class Player(Solid):
         if self.speed.y < self.physicsConfig["maxFall"]:
             self.speed.y += self.physicsConfig["gravity"]
 
-    def update(self, game: Game):
-        """Updates the player relative to the given Game"""
+    def update(self, game: Game) -> typing.List[Item]:
+        """Updates the player relative to the given Game
+        Returns the Items collected during the update
+        """
 
         # Calculate impulse
         # Updates self.speed
@@ -478,11 +592,289 @@ class Player(Solid):
         self.move(self.speed, game.solids)
 
         # Collect any collectables
-        self.collect(game.collectables)
+        collected = self.collect(game.collectables)
 
         # Align visual rect with actual hitbox
         self.rect.center = self.hitbox.center
 
+        return collected
+
+class Entities: # pylint: disable=too-many-instance-attributes
+    """Structure-of-arrays store for many moving entities
+    Positions, speeds, hitbox sizes and physics constants live in contiguous numpy arrays,
+    indexed by an entity slot, so that movement can be computed for every entity at once.
+    Movement and collision follow the same rules as Player.move, against a SolidMap.
+    Physics constants use the same format as Player.physicsDictionary
+    """
+
+    # Physics constants stored per entity, in Player.physicsDictionary naming
+    physicsNames = ("jump", "gravity", "maxFall", "maxSpeed", "speed", "jumps")
+
+    # Columns of Entities.state, physics constants are prefixed to tell them apart
+    stateNames = (
+        "x", "y", "width", "height", "speedX", "speedY", "jumps", "kind",
+        *("physics." + name for name in physicsNames),
+    )
+
+    def __init__(self, capacity: int = 256):
+
+        # Number of slots ever used, slots past this are unallocated
+        self.count = 0
+        # Slots freed by kill, reused by spawn
+        self.free = []
+
+        # Images referenced by entities, entities store an index into this list
+        self.images = []
+
+        # Whether the slot holds a live entity
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        # Hitbox topleft, hitbox size and speed, as (x, y) rows
+        self.position = numpy.zeros((capacity, 2), dtype=numpy.int64)
+        self.size = numpy.zeros((capacity, 2), dtype=numpy.int64)
+        self.speed = numpy.zeros((capacity, 2), dtype=numpy.int64)
+        # Jumps currently available
+        self.jumps = numpy.zeros(capacity, dtype=numpy.int64)
+        # Index into self.images
+        self.kind = numpy.zeros(capacity, dtype=numpy.int64)
+        # Physics constants, one row per entity, columns in physicsNames order
+        self.physics = numpy.zeros((capacity, len(self.physicsNames)), dtype=numpy.int64)
+
+    @staticmethod
+    def _grown(array: numpy.ndarray, capacity: int) -> numpy.ndarray:
+        """Returns a copy of the array with capacity rows, keeping existing rows"""
+        grown = numpy.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _grow(self, capacity: int) -> None:
+        """Grows the arrays to the given capacity, keeping existing data"""
+        self.alive = self._grown(self.alive, capacity)
+        self.position = self._grown(self.position, capacity)
+        self.size = self._grown(self.size, capacity)
+        self.speed = self._grown(self.speed, capacity)
+        self.jumps = self._grown(self.jumps, capacity)
+        self.kind = self._grown(self.kind, capacity)
+        self.physics = self._grown(self.physics, capacity)
+
+    def __len__(self) -> int:
+        """Returns the number of live entities"""
+        return self.count - len(self.free)
+
+    def constant(self, name: str) -> numpy.ndarray:
+        """Returns a view of the given physics constant for every slot"""
+        return self.physics[:, self.physicsNames.index(name)]
+
+    def spawn(self, image: pygame.Surface, hitbox: pygame.Rect,
+              physicsConfig: typing.Dict[str, int]) -> int:
+        """Adds an entity and returns its slot
+        The physicsConfig should be made with Player.physicsDictionary
+        """
+        # Reuse a freed slot if possible
+        if self.free:
+            slot = self.free.pop()
+        else:
+            # Double capacity when full
+            if self.count == self.alive.size:
+                self._grow(max(1, self.alive.size*2))
+            slot = self.count
+            self.count += 1
+
+        # Find or register image
+        for kind, known in enumerate(self.images):
+            if known is image:
+                break
+        else:
+            kind = len(self.images)
+            self.images.append(image)
+
+        # Fill slot
+        self.alive[slot] = True
+        self.position[slot] = hitbox.topleft
+        self.size[slot] = hitbox.size
+        self.speed[slot] = (0, 0)
+        self.jumps[slot] = 0
+        self.kind[slot] = kind
+        self.physics[slot] = [physicsConfig[name] for name in self.physicsNames]
+
+        return slot
+
+    def kill(self, slot: int) -> None:
+        """Removes the entity in the given slot"""
+        if self.alive[slot]:
+            self.alive[slot] = False
+            self.free.append(slot)
+
+    def state(self) -> numpy.ndarray:
+        """Returns a copy of every live entity as a row, for saves
+        Columns are named by Entities.stateNames
+        """
+        slots = self.active()
+        return numpy.column_stack((
+            self.position[slots], self.size[slots], self.speed[slots],
+            self.jumps[slots], self.kind[slots], self.physics[slots],
+        ))
+
+    def hitbox(self, slot: int) -> pygame.Rect:
+        """Returns a Rect copy of the hitbox of the entity in the given slot"""
+        return pygame.Rect(*self.position[slot], *self.size[slot])
+
+    def active(self) -> numpy.ndarray:
+        """Returns the slots of every live entity"""
+        return numpy.flatnonzero(self.alive[:self.count])
+
+    def steer(self, slots: numpy.ndarray, direction: numpy.ndarray) -> None:
+        """Updates horizontal speeds of the given slots from directions of -1, 0 or 1
+        Mirrors Player.accelerate_x and Player.decelerate_x
+        """
+        speed = self.speed[slots, 0]
+        change = self.constant("speed")[slots]
+        maxSpeed = self.constant("maxSpeed")[slots]
+
+        # Accelerate entities with a direction that are under max speed, capping the result
+        accelerate = (direction != 0) & (numpy.abs(speed) < maxSpeed)
+        speed = numpy.where(
+            accelerate, numpy.clip(speed + direction*change, -maxSpeed, maxSpeed), speed
+        )
+
+        # Decelerate entities without a direction towards 0, clipping at 0
+        speed = numpy.where(
+            direction == 0,
+            numpy.sign(speed) * numpy.maximum(numpy.abs(speed) - change, 0),
+            speed
+        )
+
+        self.speed[slots, 0] = speed
+
+    def jump(self, slots: numpy.ndarray) -> None:
+        """Makes the given slots jump, if they have jumps remaining"""
+        slots = slots[self.jumps[slots] > 0]
+        self.speed[slots, 1] = -self.constant("jump")[slots]
+        self.jumps[slots] -= 1
+
+    def fall(self, slots: numpy.ndarray) -> None:
+        """Applies gravity to the given slots that are below max fall speed"""
+        slots = slots[self.speed[slots, 1] < self.constant("maxFall")[slots]]
+        self.speed[slots, 1] += self.constant("gravity")[slots]
+
+    @staticmethod
+    def _tile_hits(first: numpy.ndarray, last: numpy.ndarray,
+                   axis: int, solids: SolidMap) -> numpy.ndarray:
+        """Returns an (entities, span) array of whether any solid tile is hit in each line of tiles
+        first and last are the inclusive tile spans covered by each hitbox, as (x, y) rows,
+        and lines run across the given axis, starting at first
+        """
+        other = 1 - axis
+
+        # Widest number of tiles covered along each axis, for the fixed-size loops below
+        spans = (last - first).max(axis=0) + 1
+
+        hits = numpy.zeros((len(first), spans[axis]), dtype=bool)
+        tile = numpy.empty_like(first)
+        for line in range(spans[axis]):
+            tile[:, axis] = first[:, axis] + line
+            inLine = tile[:, axis] <= last[:, axis]
+            for step in range(spans[other]):
+                tile[:, other] = first[:, other] + step
+                hits[:, line] |= (
+                    inLine & (tile[:, other] <= last[:, other])
+                    & solids.solid(tile[:, 0], tile[:, 1])
+                )
+        return hits
+
+    def _collide(self, slots: numpy.ndarray, axis: int, solids: SolidMap) -> None:
+        """Resolves collisions of the given slots along one axis after displacement
+        Snaps hitboxes to the nearest colliding tile edge and stops movement, like Player.move
+        """
+        scale = solids.scale
+
+        # Tile span covered by each hitbox, inclusive, on both axes
+        # Rects only collide when overlapping, so the far edge uses (edge - 1)
+        first = self.position[slots] // scale
+        last = (self.position[slots] + self.size[slots] - 1) // scale
+        hits = self._tile_hits(first, last, axis, solids)
+
+        # Select colliding entities
+        collided = hits.any(axis=1)
+        if not collided.any():
+            return
+        hits = hits[collided]
+        slots = slots[collided]
+        start = first[collided, axis]
+        forward = self.speed[slots, axis] > 0
+
+        # Moving forward collides with the near edge of the closest tile line,
+        # otherwise (including no movement) with the far edge of the furthest tile line
+        nearest = numpy.argmax(hits, axis=1)
+        furthest = hits.shape[1] - 1 - numpy.argmax(hits[:, ::-1], axis=1)
+        self.position[slots, axis] = numpy.where(
+            forward,
+            (start + nearest)*scale - self.size[slots, axis],
+            (start + furthest + 1)*scale,
+        )
+
+        # Landing resets jumps
+        if axis == 1:
+            landed = slots[forward]
+            self.jumps[landed] = self.constant("jumps")[landed]
+
+        # Stop movement
+        self.speed[slots, axis] = 0
+
+    def move(self, solids: SolidMap) -> None:
+        """Moves every live entity by its speed, stopping on collision with solid tiles
+        Horizontal movement is resolved before vertical movement, like Player.move
+        """
+        slots = self.active()
+        if not slots.size:
+            return
+        for axis in (0, 1):
+            self.position[slots, axis] += self.speed[slots, axis]
+            self._collide(slots, axis, solids)
+
+    def update(self, solids: SolidMap,
+               direction: numpy.ndarray = None, jumping: numpy.ndarray = None) -> None:
+        """Updates every live entity in the same order as Player.update
+        direction is an optional per-slot array of -1, 0 or 1 horizontal inputs,
+        jumping is an optional per-slot boolean array of jump inputs
+        """
+        slots = self.active()
+        if direction is not None:
+            self.steer(slots, direction[slots])
+        if jumping is not None:
+            self.jump(slots[jumping[slots]])
+        self.fall(slots)
+        self.move(solids)
+
+    def sprites(self, area: pygame.Rect) -> typing.List[typing.Tuple[pygame.Surface, tuple]]:
+        """Returns an (image, topleft) pair for every live entity whose image touches the area
+        Images are centered on hitboxes, like Player
+        """
+        slots = self.active()
+        if not slots.size:
+            return []
+
+        # Image sizes by kind, indexed per slot
+        sizes = numpy.array([image.get_size() for image in self.images], dtype=numpy.int64)
+        imageSize = sizes[self.kind[slots]]
+
+        # Center image rects on hitboxes, rounding like Rect.center
+        topleft = self.position[slots] + self.size[slots]//2 - imageSize//2
+
+        # Cull images that do not overlap the area, with the same rules as Rect.colliderect
+        visible = (
+            (topleft[:, 0] < area.right) & (topleft[:, 0] + imageSize[:, 0] > area.left)
+            & (topleft[:, 1] < area.bottom) & (topleft[:, 1] + imageSize[:, 1] > area.top)
+        )
+
+        # Only build Python objects for visible entities
+        images = self.images
+        return [
+            (images[kind], (x, y))
+            for kind, (x, y) in zip(
+                self.kind[slots[visible]].tolist(), topleft[visible].tolist()
+            )
+        ]
+
 # A Viewbox represents a view, and provides easy ways to produce a surface
 # that only includes sprites in a specific region, with a offset
 class Viewbox:
@@ -507,14 +899,24 @@ class Viewbox:
             # e.g. viewbox offset: (5, 5) will make a sprite at (5, 5) be drawn at (0, 0)
             self.image.blit(sprite.image, sprite.rect.move(-self.rect.x, -self.rect.y))
 
+    def render_pairs(self, pairs: typing.Iterable[typing.Tuple[pygame.Surface, tuple]]):
+        """Draws the given (image, topleft) pairs onto the surface in a single batch
+        Adjusts position based on viewbox offset, like render
+        """
+        x, y = self.rect.topleft
+        self.image.blits(
+            ((image, (left - x, top - y)) for image, (left, top) in pairs), doreturn=False
+        )
+
 # Game object, used so that we can pass a single object into things like a Player
 # which can then read what it needs. Should be more scalable than dicts
-class Game:
+class Game: # pylint: disable=too-many-instance-attributes
     """Stores information about game state and provides methods for updating/modifying the state
     images: dictionary of surfaces used for various entities
     scale: the scale of tiles in the game, especially used by the grid"""
 
-    def __init__(self, images: typing.Dict[str, pygame.Surface], player: Player, scale: int):
+    def __init__(self, images: typing.Dict[str, pygame.Surface], player: Player, scale: int,
+                 trackChanges: bool = False):
 
         # Reference image set
         self.images = images
@@ -534,9 +936,35 @@ class Game:
         # Create grid object, which stores blocks in a ordered manner, mostly for generation
         self.grid = Grid(scale)
 
+        # Track solid tiles for batched entity collisions
+        self.solidMap = SolidMap(scale)
+
+        # Create entity store for non-player moving entities
+        self.entities = Entities()
+
+        # Tiles changed since the last save, in order, as tile: "block", "space" or "coin"
+        # None unless trackChanges is set, since only saves drain it
+        self.changed = {} if trackChanges else None
+
         # Initialize input dictionary
         self.inputs = {"events": None, "keyboard": None}
 
+    def add_solid(self, tile: typing.Tuple[int, int], image: pygame.Surface) -> Block:
+        """Creates a solid Block at the given tile, adding it to the grid, solids and solidMap"""
+        block = self.grid.add_block(tile, image)
+        self.solids.add(block)
+        self.solidMap.add(tile)
+        self.mark(tile, "block")
+        return block
+
+    def add_space(self, tile: typing.Tuple[int, int], image: pygame.Surface) -> Block:
+        """Creates an empty space Block at the given tile, adding it to the grid and spaces"""
+        block = self.grid.add_block(tile, image)
+        self.spaces.add(block)
+        self.solidMap.discard(tile)
+        self.mark(tile, "space")
+        return block
+
     def generate(self, tiles: typing.Collection[tuple], densityConfig: dict, destructive=False):
         """Generates tiles into the Game's grid, generates on the tiles given
         Uses densityConfig for generation probabilities
@@ -555,11 +983,12 @@ class Game:
                     self.collectables.add(Item(
                         self.images["coin"], self.grid.rect(tile), Inventory({"coin": 1})
                     ))
-                    self.spaces.add(self.grid.add_block(tile, self.images["space"]))
+                    self.add_space(tile, self.images["space"])
+                    self.mark(tile, "coin")
                 elif val < densityConfig["blockDensity"]:
                     # Attempt "splash" generation
                     # Create main block
-                    self.solids.add(self.grid.add_block(tile, self.images["block"]))
+                    self.add_solid(tile, self.images["block"])
                     # Create range object
                     area = range(
                         -densityConfig["blockClumpRadius"],
@@ -572,12 +1001,42 @@ class Game:
                             if random.random() < densityConfig["blockClumpDensity"]:
                                 if destructive or (tile[0]+x, tile[1]+y) not in self.grid:
                                     # Generate offset based on current x,y
-                                    self.solids.add(self.grid.add_block(
+                                    self.add_solid(
                                         (tile[0]+x, tile[1]+y), self.images["block"]
-                                    ))
+                                    )
                 else:
                     # Signifies that this has been generated, just without block/coin
-                    self.spaces.add(self.grid.add_block(tile, self.images["space"]))
+                    self.add_space(tile, self.images["space"])
+
+    def mark(self, tile: typing.Tuple[int, int], kind: str) -> None:
+        """Records that the given tile changed to kind, if changes are tracked"""
+        if self.changed is not None:
+            self.changed[tile] = kind
+
+    def changes(self, count: int) -> typing.Dict[tuple, str]:
+        """Removes and returns up to count of the oldest tile changes since the last save"""
+        tiles = list(itertools.islice(self.changed, count))
+        return {tile: self.changed.pop(tile) for tile in tiles}
+
+    def unchange(self, changes: typing.Dict[tuple, str]) -> None:
+        """Puts back tile changes taken by Game.changes that could not be saved
+        Newer changes to the same tiles are kept
+        """
+        for tile, kind in changes.items():
+            self.changed.setdefault(tile, kind)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of the state needed for a save, other than tiles
+        Does not copy the grid, so the cost depends on the number of entities, not the world size
+        Tiles are saved separately through Game.changes
+        Encode it with encode_state
+        """
+        return {
+            "position": self.player.hitbox.topleft,
+            "speed": tuple(self.player.speed),
+            "inventory": dict(self.player.inventory.storage),
+            "entities": self.entities.state(),
+        }
 
     def update(self, events, viewbox: Viewbox):
         """Updates the Game, interacting entities appropriately
@@ -589,8 +1048,12 @@ class Game:
         self.inputs["events"] = events
         self.inputs["keyboard"] = pygame.key.get_pressed()
 
-        # Update player with this game
-        self.player.update(self)
+        # Update player with this game, recording the tiles of any collected items as emptied
+        for item in self.player.update(self):
+            self.mark(self.grid.index(item.hitbox.topleft), "space")
+
+        # Move all other entities at once
+        self.entities.update(self.solidMap)
 
         # Generate uncharted territory
         # Pull visible tiles
@@ -599,6 +1062,257 @@ class Game:
         # Generate tiles, using global config for now
         self.generate(visibleTiles, config)
 
+class Budget:
+    """Per-frame time budget for a cooperative background task
+    Tasks await Budget.wait() between small chunks of work,
+    which returns immediately while the task has time left in the current frame,
+    and otherwise suspends the task until the next frame has finished ticking and rendering
+    """
+
+    def __init__(self, scheduler: Scheduler, seconds: float):
+
+        # Reference scheduler
+        self.scheduler = scheduler
+
+        # Time allowed per frame
+        self.seconds = seconds
+
+        # Event loop time that the current slice ends, starts expired
+        self.deadline = 0.0
+
+    def left(self) -> float:
+        """Returns the time left in the current slice, in seconds"""
+        return self.deadline - asyncio.get_running_loop().time()
+
+    def finish(self) -> None:
+        """Gives up the rest of the current slice, so the next wait lasts until the next frame"""
+        self.deadline = 0.0
+
+    async def wait(self) -> None:
+        """Waits until the task has time left in a frame"""
+        while self.left() <= 0:
+            # Wait for the next frame to open its idle window
+            await self.scheduler.window()
+            # Take a slice, never running past the end of the window
+            self.deadline = min(
+                asyncio.get_running_loop().time() + self.seconds, self.scheduler.closes
+            )
+
+class Scheduler:
+    """Runs a frame function at a fixed rate on the asyncio event loop,
+    sharing the idle time left in each frame between cooperative background tasks
+    Blocking I/O should be moved off the loop with Scheduler.offload
+    CPU-heavy work should stay on the loop, split into small chunks between Budget.wait calls,
+    since in a thread it would hold the GIL and stall frames
+    reserve is the time kept free at the end of each frame to absorb scheduling jitter
+    """
+
+    def __init__(self, tps: int, reserve: float):
+
+        # Reference frame rate and reserve
+        self.tps = tps
+        self.reserve = reserve
+
+        # Set once the frames stop, after which windows stay open with no deadline
+        self.stopped = asyncio.Event()
+
+        # Event loop time that the current idle window closes
+        self.closes = 0.0
+
+        # Future resolved when the next idle window opens, created when first awaited
+        self._opened = None
+
+        # Background tasks, as task: whether it is left to finish when the frames stop
+        self.tasks = {}
+
+        # Executor for blocking I/O, which releases the GIL while it waits
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+
+    def budget(self, seconds: float) -> Budget:
+        """Creates a Budget allowing the given seconds of work per frame"""
+        return Budget(self, seconds)
+
+    async def window(self) -> None:
+        """Waits until the next frame opens its idle window, or returns if the frames stopped"""
+        if self.stopped.is_set():
+            return
+        if self._opened is None:
+            self._opened = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self._opened)
+
+    def _open(self, closes: float) -> None:
+        """Opens an idle window until the given event loop time, waking waiting tasks"""
+        self.closes = closes
+        if self._opened is not None:
+            self._opened.set_result(None)
+            self._opened = None
+
+    def spawn(self, coroutine: typing.Coroutine, finish: bool = False) -> asyncio.Task:
+        """Runs a background coroutine until the frames stop
+        If finish is true, the coroutine is left to complete instead of being cancelled,
+        and should return once Scheduler.stopped is set
+        """
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks[task] = finish
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task: asyncio.Task) -> None:
+        """Forgets a finished background task, reporting it if it failed"""
+        self.tasks.pop(task, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Background task %s failed", task.get_coro().__name__, exc_info=task.exception()
+            )
+
+    async def offload(self, function: typing.Callable, *args):
+        """Runs blocking I/O in a thread, returning its result without blocking frames"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *args)
+        )
+
+    async def run(self, frame: typing.Callable[[], bool]) -> None:
+        """Calls frame once per tick until it returns False
+        Between frames, background tasks run until just before the next frame is due
+        """
+        loop = asyncio.get_running_loop()
+        period = 1 / self.tps
+        deadline = loop.time()
+        try:
+            while frame():
+                # Schedule the next frame, resyncing instead of rushing if a frame overran
+                deadline = max(deadline + period, loop.time())
+
+                # Open the idle window for background tasks
+                self._open(deadline - self.reserve)
+
+                # Sleep until the next frame, letting tasks run meanwhile
+                await asyncio.sleep(deadline - loop.time())
+        finally:
+            # No frames are left to protect, so finishing tasks run without deadlines
+            self.stopped.set()
+            self._open(math.inf)
+            # Cancel the other background work, and wait for everything to end
+            for task, finish in list(self.tasks.items()):
+                if not finish:
+                    task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            # Wait for pending I/O off the loop
+            await loop.run_in_executor(None, self.executor.shutdown)
+
+async def pregenerate(scheduler: Scheduler, game: Game, viewbox: Viewbox, densityConfig: dict):
+    """Background task that generates tiles around the viewbox before they become visible
+    Generates one tile at a time within a frame budget
+    """
+    budget = scheduler.budget(densityConfig["generationBudget"])
+    margin = densityConfig["generationMargin"] * game.grid.scale
+    # View tile that was last fully generated around
+    done = None
+    while True:
+        await budget.wait()
+        # Nothing new can be needed until the view moves to another tile
+        view = game.grid.index(viewbox.rect.topleft)
+        if view == done:
+            budget.finish()
+            continue
+        # Generate uncharted tiles near the view, skipping any generated meanwhile
+        for tile in game.grid.rect_tiles(viewbox.rect.inflate(margin*2, margin*2)):
+            if tile not in game.grid:
+                await budget.wait()
+                game.generate((tile, ), densityConfig)
+        done = view
+
+async def autosave(scheduler: Scheduler, game: Game, saveConfig: dict):
+    """Background task that saves the game every autosaveInterval seconds, and when it quits
+    Spawn it with finish=True so the last save runs after the frames stop
+    Uses the autosaveBudget and savePath settings of saveConfig
+    """
+    budget = scheduler.budget(saveConfig["autosaveBudget"])
+    filename = path(saveConfig["savePath"])
+    # The first save starts a new tile journal, replacing any from an earlier game
+    append = False
+    while not scheduler.stopped.is_set():
+        # Wait for the interval, or for the game to quit
+        try:
+            await asyncio.wait_for(scheduler.stopped.wait(), saveConfig["autosaveInterval"])
+        except asyncio.TimeoutError:
+            pass
+        append = await save_game(scheduler, game, budget, filename, append) or append
+
+async def save_game(scheduler: Scheduler, game: Game, budget: Budget,
+                    filename: str, append: bool) -> bool:
+    """Saves the game to filename, encoding within the budget and writing in a thread
+    Only tiles changed since the last save are written, appended to the tile journal if append
+    Returns whether the save was written, reporting the error and keeping the changes if not
+    """
+    changes, journal = await encode_changes(game, budget)
+    state = await encode_state(game, budget)
+    try:
+        await scheduler.offload(write_save, state, journal, filename, append)
+    except OSError as error:
+        # Keep playing, and try these changes again with the next save
+        logger.error("Autosave to %s failed: %s", filename, error)
+        game.unchange(changes)
+        return False
+    return True
+
+async def encode_changes(game: Game, budget: Budget, chunk: int = 256
+                        ) -> typing.Tuple[typing.Dict[tuple, str], typing.List[bytes]]:
+    """Takes the tile changes of the game a chunk at a time within the budget
+    Returns the changes taken, and the lines of the tile journal encoding them
+    Tiles are grouped by kind in each line, later lines replace earlier ones
+    """
+    changes = {}
+    journal = []
+    while game.changed:
+        await budget.wait()
+        taken = game.changes(chunk)
+        changes.update(taken)
+        line = {"block": [], "space": [], "coin": []}
+        for tile, kind in taken.items():
+            line[kind].append(list(tile))
+        journal.append(json.dumps(line).encode("ascii") + b"\n")
+    return changes, journal
+
+async def encode_state(game: Game, budget: Budget, chunk: int = 256) -> typing.List[bytes]:
+    """Encodes a Game.snapshot as JSON, with entity rows a chunk at a time within the budget
+    Returns the parts of the encoding in order, to be written one after another
+    """
+    await budget.wait()
+    snapshot = game.snapshot()
+    head = json.dumps({
+        "position": list(snapshot["position"]),
+        "speed": list(snapshot["speed"]),
+        "inventory": snapshot["inventory"],
+    })
+    # Leave the object open for the entity rows
+    parts = [
+        head[:-1].encode("ascii"), b', "entities": {"columns": ',
+        json.dumps(Entities.stateNames).encode("ascii"), b', "rows": [',
+    ]
+    rows = snapshot["entities"]
+    for start in range(0, len(rows), chunk):
+        await budget.wait()
+        if start:
+            parts.append(b", ")
+        # Strip the brackets, so the chunks join into a single array
+        parts.append(json.dumps(rows[start:start + chunk].tolist())[1:-1].encode("ascii"))
+    parts.append(b"]}}")
+    return parts
+
+def write_save(state: typing.List[bytes], journal: typing.List[bytes],
+               filename: str, append: bool) -> None:
+    """Writes encoded state parts to the given file, and tile journal lines to filename.tiles
+    The tile journal is appended to if append is true, otherwise it is started over
+    Writes the state to a temporary file first so an interrupted save never corrupts the last one
+    """
+    with open(filename + ".tiles", "ab" if append else "wb") as file:
+        file.writelines(journal)
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as file:
+        file.writelines(state)
+    os.replace(temporary, filename)
+
 def load_images() -> typing.Dict[str, pygame.Surface]:
     """Loads the projects image resources
 
@@ -616,15 +1330,12 @@ def load_images() -> typing.Dict[str, pygame.Surface]:
         if os.path.isfile(path(os.path.join("images", name)))
     }
 
-def main():
-    """Main game script"""
+async def play():
+    """Runs the game on the asyncio event loop"""
 
     # Init pygame
     pygame.init()
 
-    # Create clock
-    clock = pygame.time.Clock()
-
     # Create viewbox
     viewbox = Viewbox(pygame.Rect(0, 0, config["windowWidth"], config["windowHeight"]))
     # Create minimap
@@ -633,7 +1344,6 @@ def main():
     # Setup window
     screen = pygame.display.set_mode(viewbox.rect.size)
     pygame.display.set_caption(config["name"])
-    tps = config["tps"]
 
     # Load images
     images = load_images()
@@ -653,15 +1363,13 @@ def main():
     )
 
     # Create game state
-    game = Game(images, player, config["blockSize"])
+    game = Game(images, player, config["blockSize"], trackChanges=True)
 
     # Create block below player
-    game.solids.add(game.grid.add_block((0, 3), images["block"]))
+    game.add_solid((0, 3), images["block"])
 
-    # Main loop
-    running = True
-    tick = 0
-    while running:
+    def frame() -> bool:
+        """Runs a single tick and render, returning False once the game is quitting"""
 
         # Dump event queue into reference
         events = pygame.event.get()
@@ -671,49 +1379,60 @@ def main():
 
             # QUIT event comes from closing the window, etc
             if event.type == pygame.QUIT:
-                running = False
-
-        # Skips the rest of the loop if the program is quitting
-        if running:
-
-            # Update the game
-            game.update(events, viewbox)
-
-            # Refresh the viewbox
-            # Lock viewbox to follow player
-            viewbox.rect.center = game.player.rect.center
-            # Fill over old image
-            viewbox.image.fill((15, 15, 15))
-            # Render the blocks and then player into the viewbox
-            viewbox.render(itertools.chain(game.solids, game.collectables, (player, )))
-
-            # Refresh the minimap
-            # Lock viewbox to follow player
-            minimap.rect.center = player.rect.center
-            # Fill over old image
-            minimap.image.fill((31, 31, 31))
-            # Render the blocks and then player into the viewbox
-            minimap.render(itertools.chain(game.solids, game.spaces, (player, )))
-
-            # Display the viewbox onto the screen
-            screen.blit(viewbox.image, (0, 0))
-            # Display the scaled minimap
-            screen.blit(
-                pygame.transform.scale(
-                    minimap.image, (
-                        int(config["minimapWidth"]*config["minimapScale"]),
-                        int(config["minimapHeight"]*config["minimapScale"])
-                    )
-                ), (0, 0)
-            )
+                return False
+
+        # Update the game
+        game.update(events, viewbox)
+
+        # Refresh the viewbox
+        # Lock viewbox to follow player
+        viewbox.rect.center = game.player.rect.center
+        # Fill over old image
+        viewbox.image.fill((15, 15, 15))
+        # Render the blocks, entities and then player into the viewbox
+        viewbox.render(game.solids)
+        viewbox.render(game.collectables)
+        viewbox.render_pairs(game.entities.sprites(viewbox.rect))
+        viewbox.render((player, ))
+
+        # Refresh the minimap
+        # Lock viewbox to follow player
+        minimap.rect.center = player.rect.center
+        # Fill over old image
+        minimap.image.fill((31, 31, 31))
+        # Render the blocks and then player into the viewbox
+        minimap.render(itertools.chain(game.solids, game.spaces, (player, )))
+
+        # Display the viewbox onto the screen
+        screen.blit(viewbox.image, (0, 0))
+        # Display the scaled minimap
+        screen.blit(
+            pygame.transform.scale(
+                minimap.image, (
+                    int(config["minimapWidth"]*config["minimapScale"]),
+                    int(config["minimapHeight"]*config["minimapScale"])
+                )
+            ), (0, 0)
+        )
 
-            # Flip display
-            pygame.display.flip()
+        # Flip display
+        pygame.display.flip()
 
-            # Increment tick
-            tick = (tick + 1)# % cycle_length
-            # Limit to determined tps
-            clock.tick(tps)
+        return True
+
+    # Create scheduler, which limits frames to determined tps
+    scheduler = Scheduler(config["tps"], config["frameReserve"])
+
+    # Start background tasks
+    scheduler.spawn(pregenerate(scheduler, game, viewbox, config))
+    scheduler.spawn(autosave(scheduler, game, config), finish=True)
+
+    # Main loop
+    await scheduler.run(frame)
+
+def main():
+    """Main game script"""
+    asyncio.run(play())
 
 # TODO inventory displays / popups. other UI elements like labels, buttons? <- Big rabbit hole
 # main script pattern
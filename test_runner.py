@@ -0,0 +1,157 @@
+"""Checks for the batched Entities physics and background tasks"""
+
+# Import core modules
+import json
+import random
+import asyncio
+
+# Import pygame and numpy
+import pygame
+import numpy
+
+# Import game
+import runner
+
+# Physics used by the main player
+physics = runner.Player.physicsDictionary(
+    jump=19, gravity=1, maxFall=32,
+    maxSpeed=7, speed=2, jumps=1,
+)
+
+def make_game(seed: int, blocks: int, spread: int, trackChanges: bool = False) -> runner.Game:
+    """Creates a Game with randomly placed solid tiles"""
+    random.seed(seed)
+    tile = pygame.Surface((32, 32))
+    game = runner.Game({"block": tile, "space": tile, "coin": tile}, None, 32, trackChanges)
+    for _ in range(blocks):
+        game.add_solid((random.randint(-spread, spread), random.randint(-spread, spread)), tile)
+    return game
+
+def free_rect(game: runner.Game, size: int) -> pygame.Rect:
+    """Returns a random rect that does not collide with any solid"""
+    while True:
+        rect = pygame.Rect(
+            random.randint(-1200, 1200), random.randint(-1200, 1200),
+            random.randint(1, size), random.randint(1, size),
+        )
+        if rect.collidelist([block.hitbox for block in game.solids]) == -1:
+            return rect
+
+def test_entities_match_player():
+    """Entities should move exactly like Players given the same inputs"""
+    for seed in range(5):
+        game = make_game(seed, 800, 40)
+        image = pygame.Surface((20, 20))
+        entities = runner.Entities(4)
+        players = []
+        for _ in range(100):
+            rect = free_rect(game, 50)
+            players.append(runner.Player(
+                image, rect.copy(), runner.Keyset(jump=0, left=1, right=2), physics
+            ))
+            entities.spawn(image, rect, physics)
+
+        generator = numpy.random.default_rng(seed)
+        for _ in range(120):
+            direction = generator.integers(-1, 2, entities.alive.size)
+            jumping = generator.random(entities.alive.size) < 0.05
+
+            # Drive players through their own impulse logic with matching inputs
+            for slot, player in enumerate(players):
+                keyboard = {0: False, 1: direction[slot] == -1, 2: direction[slot] == 1}
+                events = [pygame.event.Event(pygame.KEYDOWN, key=0)] if jumping[slot] else []
+                player.impulse({"keyboard": keyboard, "events": events})
+                player.move(player.speed, game.solids)
+            entities.update(game.solidMap, direction, jumping)
+
+            for slot, player in enumerate(players):
+                assert tuple(player.hitbox) == tuple(entities.hitbox(slot))
+                assert (player.speed.x, player.speed.y) == tuple(entities.speed[slot])
+                assert player.jumps == entities.jumps[slot]
+
+def test_solid_map_merges_changes():
+    """SolidMap keys should match the solid tiles after interleaved additions and removals"""
+    random.seed(0)
+    solids = runner.SolidMap(32)
+    for _ in range(50):
+        for _ in range(random.randint(0, 40)):
+            tile = (random.randint(-20, 20), random.randint(-20, 20))
+            if random.random() < 0.6:
+                solids.add(tile)
+            else:
+                solids.discard(tile)
+        assert numpy.array_equal(solids.keys(), runner.SolidMap.pack_tiles(solids.tiles))
+
+def make_saved_game() -> runner.Game:
+    """Creates a Game with change tracking, a player and an entity"""
+    game = make_game(0, 100, 10, trackChanges=True)
+    image = pygame.Surface((20, 20))
+    game.player = runner.Player(
+        image, pygame.Rect(0, 0, 20, 20), runner.Keyset(jump=0, left=1, right=2), physics
+    )
+    game.entities.spawn(image, pygame.Rect(0, -100, 20, 20), physics)
+    return game
+
+def saved_blocks(filename: str) -> set:
+    """Returns the solid tiles recorded in the tile journal of a save"""
+    with open(filename + ".tiles", encoding="ascii") as file:
+        return {tuple(tile) for line in file for tile in json.loads(line)["block"]}
+
+async def run_frames(count: int, start) -> None:
+    """Runs count empty frames on a Scheduler, calling start with it first"""
+    scheduler = runner.Scheduler(60, 0.002)
+    start(scheduler)
+    frames = iter(range(count))
+    await scheduler.run(lambda: next(frames, None) is not None)
+
+def test_failed_task_is_reported(caplog):
+    """A background task that raises should be reported when it finishes"""
+    async def broken():
+        raise RuntimeError("broken task")
+    asyncio.run(run_frames(5, lambda scheduler: scheduler.spawn(broken())))
+    assert "Background task broken failed" in caplog.text
+    assert "broken task" in caplog.text
+
+def test_autosave_survives_write_errors(tmp_path, monkeypatch, caplog):
+    """A failed autosave should be reported and retried, without stopping later saves"""
+    game = make_saved_game()
+
+    # Fail the first write only
+    failures = []
+    write_save = runner.write_save
+    def flaky_write_save(*args):
+        if not failures:
+            failures.append(args)
+            raise OSError("disk full")
+        write_save(*args)
+    monkeypatch.setattr(runner, "write_save", flaky_write_save)
+
+    filename = str(tmp_path / "save.json")
+    saveConfig = {"autosaveInterval": 0, "autosaveBudget": 0.001, "savePath": filename}
+    asyncio.run(run_frames(30, lambda scheduler: scheduler.spawn(
+        runner.autosave(scheduler, game, saveConfig), finish=True
+    )))
+
+    assert failures
+    assert "disk full" in caplog.text
+    # The tiles from the failed save were kept and written by a later one
+    assert saved_blocks(filename) == game.solidMap.tiles
+    with open(filename, encoding="ascii") as file:
+        assert len(json.load(file)["entities"]["rows"]) == 1
+
+def test_autosave_saves_on_quit(tmp_path):
+    """Quitting should save changes made since the last autosave"""
+    game = make_saved_game()
+    filename = str(tmp_path / "save.json")
+    saveConfig = {"autosaveInterval": 3600, "autosaveBudget": 0.001, "savePath": filename}
+    asyncio.run(run_frames(5, lambda scheduler: scheduler.spawn(
+        runner.autosave(scheduler, game, saveConfig), finish=True
+    )))
+    assert saved_blocks(filename) == game.solidMap.tiles
+    assert not game.changed
+
+def test_changes_tracked_only_when_enabled():
+    """Games should only record tile changes for saves when asked to"""
+    assert make_game(0, 10, 10).changed is None
+    game = make_game(0, 10, 10, trackChanges=True)
+    assert set(game.changed) == game.solidMap.tiles